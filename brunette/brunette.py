@@ -1,9 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
+import os
 import re
+import sys
+import gzip
+import json
+import hashlib
+import tarfile
+import itertools
+import posixpath
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from datetime import datetime
+from dataclasses import replace
 from pathspec import PathSpec
 from typing import (
+    IO,
+    Iterable,
     List,
     Optional,
     Pattern,
@@ -34,10 +54,17 @@ from black import (
     get_gitignore,
     err,
     format_str,
+    format_file_contents,
+    decode_bytes,
+    diff,
+    Changed,
+    NothingChanged,
 )
 import configparser
 
 PY36_VERSIONS = {version for version in TargetVersion if version.value >= 6}
+# How many finished diffs per worker may wait for an earlier, slower file.
+DIFF_BUFFER_PER_WORKER = 4
 
 
 def gen_python_files_in_dir(
@@ -100,6 +127,87 @@ def gen_python_files_in_dir(
                 yield child
 
 
+def read_file_list(stream: IO[str], null_separated: bool) -> Iterator[str]:
+    """Lazily read the file names listed in `stream`.
+
+    Entries are separated by newlines, or by NUL characters if
+    `null_separated` is set. Empty entries are skipped.
+    """
+    if not null_separated:
+        for line in stream:
+            line = line.rstrip('\r\n')
+            if line:
+                yield line
+
+        return
+
+    remainder = ''
+    for chunk in iter(lambda: stream.read(65536), ''):
+        *entries, remainder = (remainder + chunk).split('\0')
+        yield from filter(None, entries)
+
+    if remainder:
+        yield remainder
+
+
+def gen_python_files_from_list(
+    paths: Iterable[str],
+    root: Path,
+    include: Pattern[str],
+    exclude: Pattern[str],
+    report: 'Report',
+    gitignore: PathSpec,
+    seen: Optional[Set[Path]] = None,
+) -> Iterator[Path]:
+    """Generate the files named in `paths` whose paths are not excluded by the
+    `exclude` regex, but are included by the `include` regex.
+
+    Unlike :func:`gen_python_files_in_dir` no directories are walked, each
+    entry must name a file, other entries are reported as failures. Files
+    outside of the `root` directory are matched against their absolute path.
+    Files whose resolved paths are in `seen` are skipped. Nothing is
+    remembered across entries, so `paths` listing a file twice generates it
+    twice.
+
+    `report` is where output about exclusions and failures goes.
+    """
+    seen = set() if seen is None else seen
+    for entry in paths:
+        child = Path(entry)
+        if not child.is_file():
+            report.failed(child, 'no such file')
+            continue
+
+        if gitignore.match_file(child.as_posix()):
+            report.path_ignored(child, 'matches the .gitignore file content')
+            continue
+
+        try:
+            resolved = child.resolve()
+        except OSError as e:
+            report.path_ignored(child, f'cannot be read because {e}')
+            continue
+
+        if resolved in seen:
+            continue
+
+        try:
+            normalized_path = '/' + resolved.relative_to(root).as_posix()
+        except ValueError:
+            normalized_path = resolved.as_posix()
+
+        exclude_match = exclude.search(normalized_path)
+        if exclude_match and exclude_match.group(0):
+            report.path_ignored(
+                child, 'matches the --exclude regular expression'
+            )
+            continue
+
+        include_match = include.search(normalized_path)
+        if include_match:
+            yield child
+
+
 def patched_normalize_string_quotes(s: str) -> str:
     """
     Prefer SINGLE quotes but only if it doesn't cause more escaping.
@@ -189,6 +297,18 @@ def patched_normalize_string_quotes(s: str) -> str:
     return f'{prefix}{new_quote}{new_body}{new_quote}'
 
 
+def patch_string_quotes(single_quotes: bool) -> None:
+    """Switch black between its own and our single-quote preferring
+    ``normalize_string_quotes``."""
+    normalize = (
+        patched_normalize_string_quotes
+        if single_quotes
+        else black.strings.normalize_string_quotes
+    )
+    black.linegen.normalize_string_quotes = normalize
+    black.trans.normalize_string_quotes = normalize
+
+
 def read_config_file(ctx, param, value):
     if not value:
         root = black.find_project_root(ctx.params.get('src', ()))
@@ -227,10 +347,331 @@ def read_config_file(ctx, param, value):
     return value
 
 
-def reformat_many(sources, *args, **kwargs):
-    """Monkeypatched to reformat multiple files using ``black.reformat_one``."""
+def should_verify(
+    src: Path, fraction: float, root: Optional[Path] = None
+) -> bool:
+    """Decide whether `src` gets the --safe sanity checks.
+
+    The choice is a deterministic function of the path relative to `root`
+    (the project root), so repeated runs, from any working directory or
+    checkout location, verify the same subset of files. Files outside of
+    `root` are decided by the path as given.
+    """
+    if fraction >= 1:
+        return True
+
+    if fraction <= 0:
+        return False
+
+    path = src.as_posix()
+    if root is not None:
+        try:
+            path = src.resolve().relative_to(root).as_posix()
+        except (OSError, ValueError):
+            pass
+
+    digest = hashlib.sha1(path.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < fraction
+
+
+def reformat_many(
+    sources, fast, write_back, mode, report, verify_fraction=None, root=None
+):
+    """Monkeypatched to reformat multiple files using ``black.reformat_one``.
+
+    When `verify_fraction` is given it overrides `fast` per file, see
+    :func:`should_verify`.
+    """
     for src in sources:
-        black.reformat_one(src, *args, **kwargs)
+        if verify_fraction is not None:
+            fast = not should_verify(src, verify_fraction, root)
+        black.reformat_one(
+            src, fast=fast, write_back=write_back, mode=mode, report=report
+        )
+
+
+def encode_diff(
+    name: str,
+    src: str,
+    dst: str,
+    mtime: Optional[float],
+    encoding: str,
+    newline: str,
+    diff_format: str,
+) -> bytes:
+    """A diff between `src` and `dst` of `name`, encoded for output.
+
+    Unified diffs use the encoding and newlines of the file, ``jsonl`` writes
+    a UTF-8 JSON object with the path and diff. Without `mtime` the diff is
+    labelled like black's for stdin.
+    """
+    now = datetime.utcnow()
+    if mtime is None:
+        src_name = f'STDIN\t{now} +0000'
+        dst_name = f'STDOUT\t{now} +0000'
+    else:
+        then = datetime.utcfromtimestamp(mtime)
+        src_name = f'{name}\t{then} +0000'
+        dst_name = f'{name}\t{now} +0000'
+    diff_contents = diff(src, dst, src_name, dst_name)
+    if diff_format == 'jsonl':
+        record = {'path': name, 'diff': diff_contents}
+        return (json.dumps(record) + '\n').encode('utf-8')
+
+    return diff_contents.replace('\n', newline).encode(encoding)
+
+
+def diff_one(
+    src: Path,
+    fast: bool,
+    mode: FileMode,
+    single_quotes: bool,
+    diff_format: str,
+    data: Optional[bytes] = None,
+) -> Optional[bytes]:
+    """Format `src` and return its diff, encoded for output.
+
+    Returns None if nothing would change. Runs in a worker process, so the
+    quote preference is applied here as well. `data` is used as the
+    contents of `src` when given (for stdin).
+    """
+    patch_string_quotes(single_quotes)
+    if src.suffix == '.pyi':
+        mode = replace(mode, is_pyi=True)
+    elif src.suffix == '.ipynb':
+        mode = replace(mode, is_ipynb=True)
+
+    mtime = None
+    if data is None:
+        mtime = src.stat().st_mtime
+        with open(src, 'rb') as buf:
+            data = buf.read()
+    src_contents, encoding, newline = decode_bytes(data)
+    try:
+        dst_contents = format_file_contents(src_contents, fast=fast, mode=mode)
+    except NothingChanged:
+        return None
+
+    return encode_diff(
+        str(src),
+        src_contents,
+        dst_contents,
+        mtime,
+        encoding,
+        newline,
+        diff_format,
+    )
+
+
+def diff_many(
+    sources,
+    fast,
+    mode,
+    report,
+    stream,
+    single_quotes=False,
+    diff_format='unified',
+    workers=None,
+    verify_fraction=None,
+    root=None,
+):
+    """Write the diffs of `sources` to the binary `stream`, in order.
+
+    Files are formatted and diffed in parallel by `workers` processes, but
+    output strictly follows the order of `sources`. At most
+    ``DIFF_BUFFER_PER_WORKER`` diffs per worker are held while waiting for
+    an earlier file, and `sources` is consumed lazily.
+    """
+    workers = workers or os.cpu_count() or 1
+    if sys.platform == 'win32':
+        # Work around https://bugs.python.org/issue26903
+        workers = min(workers, 60)
+    executor: Executor
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    except (ImportError, NotImplementedError, OSError):
+        # No multiprocessing support on this system (e.g. AWS Lambda).
+        workers = 1
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    def emit(src, future):
+        try:
+            data = future.result()
+        except Exception as exc:
+            report.failed(src, str(exc))
+            return
+
+        if data is None:
+            report.done(src, Changed.NO)
+        else:
+            stream.write(data)
+            report.done(src, Changed.YES)
+
+    pending = deque()
+    with executor:
+        for src in sources:
+            if verify_fraction is not None:
+                fast = not should_verify(src, verify_fraction, root)
+            data = sys.stdin.buffer.read() if str(src) == '-' else None
+            future = executor.submit(
+                diff_one, src, fast, mode, single_quotes, diff_format, data
+            )
+            pending.append((src, future))
+            if len(pending) >= workers * DIFF_BUFFER_PER_WORKER:
+                emit(*pending.popleft())
+        while pending:
+            emit(*pending.popleft())
+    stream.flush()
+
+
+def format_tar_member(
+    name: str,
+    data: bytes,
+    mtime: float,
+    fast: bool,
+    write_back: WriteBack,
+    mode: FileMode,
+    diff_stream: Optional[IO[bytes]] = None,
+    diff_format: str = 'unified',
+) -> Optional[bytes]:
+    """Format the contents of a single archive member.
+
+    Returns the new contents, or None if nothing changed. If `write_back` is
+    DIFF, write a diff to the binary `diff_stream`, see :func:`encode_diff`.
+    """
+    if name.endswith('.pyi'):
+        mode = replace(mode, is_pyi=True)
+    elif name.endswith('.ipynb'):
+        mode = replace(mode, is_ipynb=True)
+
+    src_contents, encoding, newline = decode_bytes(data)
+    try:
+        dst_contents = format_file_contents(src_contents, fast=fast, mode=mode)
+    except NothingChanged:
+        return None
+
+    if write_back == WriteBack.DIFF:
+        diff_stream.write(
+            encode_diff(
+                name,
+                src_contents,
+                dst_contents,
+                mtime,
+                encoding,
+                newline,
+                diff_format,
+            )
+        )
+    return dst_contents.replace('\n', newline).encode(encoding)
+
+
+def reformat_tar(
+    stdin,
+    stdout,
+    fast,
+    write_back,
+    mode,
+    report,
+    include,
+    exclude,
+    verify_fraction=None,
+    root=None,
+    diff_format='unified',
+):
+    """Reformat the Python files of the tar archive read from `stdin`.
+
+    Both archives are processed as streams, one member at a time. With
+    ``WriteBack.YES`` a tar archive with every member, reformatted or not,
+    is written to `stdout`. With ``WriteBack.DIFF`` the diffs are written to
+    `stdout` in `diff_format`, otherwise only the report is output.
+    Members not matched by `include` or matched by `exclude` are passed
+    through unchanged, without being read into memory.
+
+    Raises :class:`tarfile.TarError` if `stdin` is not a (complete) tar
+    archive.
+    """
+    with ExitStack() as stack:
+        archive_in = stack.enter_context(
+            tarfile.open(fileobj=stdin, mode='r|*')
+        )
+        archive_out = None
+        if write_back == WriteBack.YES:
+            archive_out = stack.enter_context(
+                tarfile.open(fileobj=stdout, mode='w|')
+            )
+        for member in archive_in:
+            if not member.isfile():
+                if archive_out is not None:
+                    archive_out.addfile(member)
+                continue
+
+            path = Path(member.name)
+            normalized_path = '/' + posixpath.normpath(member.name).lstrip('/')
+            exclude_match = exclude.search(normalized_path)
+            if exclude_match and exclude_match.group(0):
+                report.path_ignored(
+                    path, 'matches the --exclude regular expression'
+                )
+                included = False
+            else:
+                included = bool(include.search(normalized_path))
+            if not included:
+                # Copied through in chunks, never read into memory.
+                if archive_out is not None:
+                    archive_out.addfile(member, archive_in.extractfile(member))
+                continue
+
+            data = archive_in.extractfile(member).read()
+            if verify_fraction is not None:
+                # Members are sampled as if extracted at the project root.
+                fast = not should_verify(
+                    (root or Path()) / normalized_path.lstrip('/'),
+                    verify_fraction,
+                    root,
+                )
+            try:
+                new_data = format_tar_member(
+                    member.name,
+                    data,
+                    member.mtime,
+                    fast,
+                    write_back,
+                    mode,
+                    diff_stream=stdout,
+                    diff_format=diff_format,
+                )
+            except Exception as exc:
+                report.failed(path, str(exc))
+            else:
+                if new_data is None:
+                    report.done(path, Changed.NO)
+                else:
+                    report.done(path, Changed.YES)
+                    data = new_data
+                    member.size = len(data)
+
+            if archive_out is not None:
+                archive_out.addfile(member, io.BytesIO(data))
+
+
+@contextmanager
+def diff_output(compress: bool) -> Iterator[IO[bytes]]:
+    """Binary stdout, gzip compressed if `compress` is set.
+
+    Closing the gzip stream only writes its trailer, stdout stays open.
+    """
+    if not compress:
+        yield sys.stdout.buffer
+        return
+
+    with gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb') as stream:
+        yield stream
+
+
+def print_report(report: 'Report', quiet: bool, verbose: bool) -> None:
+    if verbose or not quiet:
+        out('Oh no! 💥 💔 💥' if report.return_code else 'All done! ✨ 🍰 ✨')
+        click.secho(str(report), err=True)
 
 
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
@@ -300,11 +741,44 @@ def reformat_many(sources, *args, **kwargs):
     is_flag=True,
     help="Don't write the files back, just output a diff for each file on stdout.",
 )
+@click.option(
+    '--diff-format',
+    type=click.Choice(['unified', 'jsonl']),
+    default='unified',
+    help=(
+        'Output format of --diff, jsonl writes one JSON object with the path '
+        'and diff per file.'
+    ),
+    show_default=True,
+)
+@click.option(
+    '--diff-gzip',
+    is_flag=True,
+    help='Compress the --diff output with gzip.',
+)
+@click.option(
+    '-W',
+    '--workers',
+    type=click.IntRange(min=1),
+    help=(
+        'Number of parallel workers used for --diff [default: number of CPUs '
+        'in the system]'
+    ),
+)
 @click.option(
     '--fast/--safe',
     is_flag=True,
     help='If --fast given, skip temporary sanity checks. [default: --safe]',
 )
+@click.option(
+    '--verify-fraction',
+    type=click.FloatRange(0, 1),
+    help=(
+        'Run the --safe sanity checks on a deterministic fraction of files '
+        '(chosen by path) and skip them on the rest.  0 behaves like --fast, '
+        '1 like --safe.  Overrides --fast/--safe when given.'
+    ),
+)
 @click.option(
     '--include',
     type=str,
@@ -330,6 +804,41 @@ def reformat_many(sources, *args, **kwargs):
     ),
     show_default=True,
 )
+@click.option(
+    '--files-from',
+    type=click.File('r'),
+    help=(
+        'Read the files to format from PATH (or stdin if -) instead of '
+        'walking directories.  The --include and --exclude checks still '
+        'apply.  Names listed more than once are formatted once per entry.'
+    ),
+)
+@click.option(
+    '-z',
+    '--null',
+    is_flag=True,
+    help=(
+        'Names in --files-from are separated by NUL characters, not '
+        'newlines.'
+    ),
+)
+@click.option(
+    '--tar',
+    is_flag=True,
+    help=(
+        'Read a tar archive of sources on stdin and write the archive with '
+        'the reformatted files to stdout.  With --check or --diff only the '
+        'status or the diffs are output.'
+    ),
+)
+@click.option(
+    '--lsp',
+    is_flag=True,
+    help=(
+        'Run as a Language Server Protocol server on stdin/stdout.  Settings '
+        'are read from the setup.cfg of each workspace.'
+    ),
+)
 @click.option(
     '-q',
     '--quiet',
@@ -382,7 +891,11 @@ def main(
     target_version: List[TargetVersion],
     check: bool,
     diff: bool,
+    diff_format: str,
+    diff_gzip: bool,
+    workers: Optional[int],
     fast: bool,
+    verify_fraction: Optional[float],
     pyi: bool,
     py36: bool,
     skip_string_normalization: bool,
@@ -391,6 +904,10 @@ def main(
     verbose: bool,
     include: str,
     exclude: str,
+    files_from: Optional[IO[str]],
+    null: bool,
+    tar: bool,
+    lsp: bool,
     src: Tuple[str],
     config: Optional[str],
 ) -> None:
@@ -419,14 +936,21 @@ def main(
     )
 
     if single_quotes:
-        black.linegen.normalize_string_quotes = patched_normalize_string_quotes
-        black.trans.normalize_string_quotes = patched_normalize_string_quotes
+        patch_string_quotes(True)
+
+    if (diff_format != 'unified' or diff_gzip) and not diff:
+        err('--diff-format and --diff-gzip require --diff')
+        ctx.exit(2)
 
     if config and verbose:
         out(f'Using configuration from {config}.', bold=False, fg='blue')
     if code is not None:
         print(format_str(code, mode=mode))
         ctx.exit(0)
+    if lsp:
+        from brunette.lsp import serve
+
+        ctx.exit(serve(sys.stdin.buffer, sys.stdout.buffer))
     try:
         include_regex = re_compile_maybe_verbose(include)
     except re.error:
@@ -441,14 +965,45 @@ def main(
     root = find_project_root(src)
     if isinstance(root, tuple):
         root = root[0]
+    if tar:
+        if src or files_from is not None:
+            err('Cannot use --tar with source paths or --files-from')
+            ctx.exit(2)
+
+        try:
+            with diff_output(diff_gzip) as stdout:
+                reformat_tar(
+                    stdin=sys.stdin.buffer,
+                    stdout=stdout,
+                    fast=fast,
+                    write_back=write_back,
+                    mode=mode,
+                    report=report,
+                    include=include_regex,
+                    exclude=exclude_regex,
+                    verify_fraction=verify_fraction,
+                    root=root,
+                    diff_format=diff_format,
+                )
+        except (tarfile.TarError, EOFError) as e:
+            err(f'error: cannot read tar archive from stdin: {e}')
+            ctx.exit(123)
+
+        print_report(report, quiet, verbose)
+        ctx.exit(report.return_code)
+
     sources: Set[Path] = set()
-    path_empty(
-        src=src,
-        quiet=quiet,
-        verbose=verbose,
-        ctx=ctx,
-        msg='No Path provided. Nothing to do 😴',
-    )
+    if files_from is None:
+        path_empty(
+            src=src,
+            quiet=quiet,
+            verbose=verbose,
+            ctx=ctx,
+            msg='No Path provided. Nothing to do 😴',
+        )
+    elif files_from.name == '<stdin>' and '-' in src:
+        err('Cannot read both --files-from and source code from stdin')
+        ctx.exit(2)
     for s in src:
         p = Path(s)
         if p.is_dir():
@@ -467,22 +1022,63 @@ def main(
             sources.add(p)
         else:
             err(f'invalid path: {s}')
-    if len(sources) == 0:
+    if len(sources) == 0 and files_from is None:
         if verbose or not quiet:
             out('No Python files are present to be formatted. Nothing to do 😴')
         ctx.exit(0)
 
-    reformat_many(
-        sources=sources,
-        fast=fast,
-        write_back=write_back,
-        mode=mode,
-        report=report,
-    )
+    # Sorted, so that output like --diff comes in a deterministic order.
+    sources = sorted(sources)
+    if files_from is not None:
+        # Stream the listed files, large manifests are never held in memory.
+        # Only files also given as source paths are skipped, duplicates
+        # within the list are up to the caller.
+        listed = gen_python_files_from_list(
+            read_file_list(files_from, null),
+            root,
+            include_regex,
+            exclude_regex,
+            report,
+            get_gitignore(root),
+            seen={p.resolve() for p in sources if str(p) != '-'},
+        )
+        first = next(listed, None)
+        if first is None and not sources and not report.failure_count:
+            if verbose or not quiet:
+                out(
+                    'No Python files are present to be formatted. '
+                    'Nothing to do 😴'
+                )
+            ctx.exit(0)
 
-    if verbose or not quiet:
-        out('Oh no! 💥 💔 💥' if report.return_code else 'All done! ✨ 🍰 ✨')
-        click.secho(str(report), err=True)
+        sources = itertools.chain(sources, filter(None, [first]), listed)
+
+    if write_back is WriteBack.DIFF:
+        with diff_output(diff_gzip) as stream:
+            diff_many(
+                sources=sources,
+                fast=fast,
+                mode=mode,
+                report=report,
+                stream=stream,
+                single_quotes=single_quotes,
+                diff_format=diff_format,
+                workers=workers,
+                verify_fraction=verify_fraction,
+                root=root,
+            )
+    else:
+        reformat_many(
+            sources=sources,
+            fast=fast,
+            write_back=write_back,
+            mode=mode,
+            report=report,
+            verify_fraction=verify_fraction,
+            root=root,
+        )
+
+    print_report(report, quiet, verbose)
     ctx.exit(report.return_code)
 
 
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Incremental formatting, one top-level statement at a time.
+
+A module is split into blocks at top-level statement boundaries. Every
+block is formatted on its own and cached, keyed by its text and the mode.
+The blank lines black puts between two blocks only depend on those two
+blocks, so they are found by formatting each pair once (also cached). After
+an edit only the changed blocks and their neighbours are formatted again.
+
+Whenever a module cannot be split safely (``# fmt: off`` regions, syntax
+the running interpreter cannot parse, ``__future__`` imports in Python 2
+code, ...) the whole module is formatted.
+"""
+
+import ast
+from collections import OrderedDict
+from dataclasses import replace
+from typing import List, Optional, Tuple
+
+import black
+from black import (
+    FileMode,
+    NothingChanged,
+    check_stability_and_equivalence,
+    format_str,
+)
+from black.comments import FMT_OFF
+from black.mode import Feature, VERSION_TO_FEATURES, TargetVersion
+
+from brunette.brunette import patched_normalize_string_quotes
+
+DEFAULT_CACHE_SIZE = 4096
+UNSAFE_FEATURES = {Feature.ASYNC_IDENTIFIERS, Feature.ASYNC_KEYWORDS}
+
+
+class CannotSplitError(Exception):
+    """The module cannot be formatted block by block."""
+
+
+def split_blocks(src: str) -> List[Tuple[str, int]]:
+    """Split `src` into top-level statements.
+
+    Returns (block, blank lines before the block) pairs. Column 0 comments
+    go with the statement they precede, indented comments and statements
+    sharing a line with the previous statement stay with the previous one.
+    """
+    if '\r' in src or any(marker in src for marker in FMT_OFF):
+        raise CannotSplitError('unsupported source')
+
+    try:
+        module = ast.parse(src)
+    except (SyntaxError, ValueError) as e:
+        raise CannotSplitError(str(e)) from None
+
+    lines = src.split('\n')
+    statements: List[List[int]] = []
+    for node in module.body:
+        decorators = getattr(node, 'decorator_list', [])
+        start = min([node.lineno, *(d.lineno for d in decorators)])
+        if statements and start <= statements[-1][1]:
+            # `a = 1; b = 2`
+            statements[-1][1] = max(statements[-1][1], node.end_lineno)
+        else:
+            statements.append([start - 1, node.end_lineno])
+    if not statements:
+        raise CannotSplitError('no statements')
+
+    boundaries = [0]
+    for (_, previous_end), (start, _) in zip(statements, statements[1:]):
+        boundary = start
+        while boundary > previous_end and (
+            not lines[boundary - 1].strip() or lines[boundary - 1][:1] == '#'
+        ):
+            boundary -= 1
+        boundaries.append(boundary)
+    boundaries.append(len(lines))
+
+    blocks = []
+    blank = 0
+    for first, last in zip(boundaries, boundaries[1:]):
+        block = lines[first:last]
+        while block and not block[0].strip():
+            blank += 1
+            block.pop(0)
+        trailing = 0
+        while block and not block[-1].strip():
+            trailing += 1
+            block.pop()
+        blocks.append(('\n'.join(block) + '\n', blank))
+        blank = trailing
+    return blocks
+
+
+class IncrementalFormatter:
+    """Formats modules block by block, reusing the blocks formatted before.
+
+    Every cache is bounded to `maxsize` entries, least recently used
+    entries are dropped first.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        # (formatted block, checked for stability and equivalence)
+        self.blocks: 'OrderedDict[tuple, Tuple[str, bool]]' = OrderedDict()
+        self.junctions: 'OrderedDict[tuple, str]' = OrderedDict()
+        self.features: 'OrderedDict[tuple, frozenset]' = OrderedDict()
+
+    def _get(self, cache, key):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _set(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def _mode_key(self, mode: FileMode) -> tuple:
+        single_quotes = (
+            black.linegen.normalize_string_quotes
+            is patched_normalize_string_quotes
+        )
+        return (mode.get_cache_key(), single_quotes)
+
+    def _target_versions(self, blocks, mode: FileMode):
+        """Detect the target versions of the whole module from the features
+        used by each of its blocks."""
+        features = set()
+        for block, _ in blocks:
+            key = (block, mode.get_cache_key())
+            used = self._get(self.features, key)
+            if used is None:
+                node = black.lib2to3_parse(block, mode.target_versions)
+                used = frozenset(black.get_features_used(node))
+                self._set(self.features, key, used)
+            features |= used
+        if features & UNSAFE_FEATURES:
+            raise CannotSplitError('async used as identifier or keyword')
+
+        return {
+            version
+            for version in TargetVersion
+            if features <= VERSION_TO_FEATURES[version]
+        }
+
+    def _format_block(self, block: str, fast: bool, mode: FileMode) -> str:
+        """Format `block`, checking it unless `fast` or checked before."""
+        key = (block, self._mode_key(mode))
+        cached = self._get(self.blocks, key)
+        if cached is None:
+            dst, verified = format_str(block, mode=mode), False
+        else:
+            dst, verified = cached
+        if not fast and not verified:
+            if dst != block:
+                check_stability_and_equivalence(block, dst, mode=mode)
+            verified = True
+        if cached != (dst, verified):
+            self._set(self.blocks, key, (dst, verified))
+        return dst
+
+    def _separator(
+        self, previous: str, blank: int, current: str, mode: FileMode
+    ) -> str:
+        """The empty lines black puts between two formatted blocks."""
+        key = (previous, blank, current, self._mode_key(mode))
+        separator = self._get(self.junctions, key)
+        if separator is None:
+            junction = format_str(previous + '\n' * blank + current, mode=mode)
+            separator = junction[len(previous) : len(junction) - len(current)]
+            stitched = previous + separator + current
+            if junction != stitched or separator.strip('\n'):
+                raise CannotSplitError('blocks depend on each other')
+
+            self._set(self.junctions, key, separator)
+        return separator
+
+    def format_str(
+        self, src_contents: str, *, mode: FileMode, fast: bool = True
+    ) -> str:
+        """Reformat a string and return new contents, like
+        :func:`black.format_str`.
+
+        If `fast` is False, every newly formatted block is checked with
+        :func:`black.check_stability_and_equivalence`.
+        """
+        if mode.is_ipynb:
+            return self._format_whole(src_contents, fast, mode)
+
+        try:
+            blocks = split_blocks(src_contents)
+            if len(blocks) < 2:
+                raise CannotSplitError('single block')
+
+            block_mode = mode
+            versions = mode.target_versions
+            if not versions:
+                versions = self._target_versions(blocks, mode)
+                # Python 2.7 supports none of the features that change the
+                # output, so then each block's own detection is as good.
+                if TargetVersion.PY27 not in versions:
+                    block_mode = replace(mode, target_versions=versions)
+            if TargetVersion.PY27 in versions and any(
+                '__future__' in block for block, _ in blocks
+            ):
+                # `from __future__ import unicode_literals` removes the `u`
+                # prefixes of the whole module, not only of its own block.
+                raise CannotSplitError('__future__ import')
+
+            dst_contents = []
+            previous: Optional[str] = None
+            for block, blank in blocks:
+                current = self._format_block(block, fast, block_mode)
+                if previous is not None:
+                    dst_contents.append(
+                        self._separator(previous, blank, current, block_mode)
+                    )
+                dst_contents.append(current)
+                previous = current
+        except Exception:
+            # Either the module cannot be split or a block failed, let black
+            # format (and report errors against) the whole module.
+            return self._format_whole(src_contents, fast, mode)
+
+        return ''.join(dst_contents)
+
+    def _format_whole(self, src_contents, fast, mode):
+        try:
+            return black.format_file_contents(
+                src_contents, fast=fast, mode=mode
+            )
+        except NothingChanged:
+            return src_contents
+
+    def format_file_contents(
+        self, src_contents: str, *, fast: bool, mode: FileMode
+    ) -> str:
+        """Reformat contents of a file and return new contents, like
+        :func:`black.format_file_contents`."""
+        if not src_contents.strip():
+            raise NothingChanged
+
+        dst_contents = self.format_str(src_contents, mode=mode, fast=fast)
+        if src_contents == dst_contents:
+            raise NothingChanged
+
+        return dst_contents
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A minimal Language Server Protocol server for brunette.
+
+Supports full and range document formatting over stdio. Open documents are
+kept in memory and updated incrementally, settings are read from the
+``[tool:brunette]`` section of each workspace's ``setup.cfg`` once. Only the
+top-level statements changed since the last request are formatted again,
+see :mod:`brunette.incremental`.
+"""
+
+import os
+import json
+import difflib
+import traceback
+from typing import (
+    IO,
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import unquote, urlparse
+
+import black
+import click
+from black import FileMode, Path, err
+
+from brunette.brunette import PY36_VERSIONS, main, patch_string_quotes
+from brunette.incremental import IncrementalFormatter
+
+# https://microsoft.github.io/language-server-protocol/specification
+TEXT_DOCUMENT_SYNC_INCREMENTAL = 2
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+SERVER_NOT_INITIALIZED = -32002
+
+
+def uri_to_path(uri: str) -> Path:
+    parsed = urlparse(uri)
+    path = unquote(parsed.path)
+    if len(path) > 2 and path[0] == '/' and path[2] == ':':
+        # file:///c:/project on Windows
+        path = path[1:]
+    return Path(path)
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+def position_to_offset(text: str, position: Dict[str, int]) -> int:
+    """Convert an LSP position (UTF-16 based) to an offset into `text`."""
+    offset = 0
+    for _ in range(position['line']):
+        newline = text.find('\n', offset)
+        if newline == -1:
+            return len(text)
+
+        offset = newline + 1
+
+    units = position['character']
+    while units > 0 and offset < len(text) and text[offset] != '\n':
+        units -= 2 if ord(text[offset]) > 0xFFFF else 1
+        offset += 1
+    return offset
+
+
+def end_position(lines: List[str]) -> Dict[str, int]:
+    """The position just past the last character of `lines`."""
+    if not lines:
+        return {'line': 0, 'character': 0}
+
+    if lines[-1].endswith('\n'):
+        return {'line': len(lines), 'character': 0}
+
+    return {'line': len(lines) - 1, 'character': utf16_length(lines[-1])}
+
+
+def text_edits(
+    src: str, dst: str, line_range: Optional[Tuple[int, int]] = None
+) -> List[Dict[str, Any]]:
+    """Build the TextEdits turning `src` into `dst`.
+
+    Edits are line based. With `line_range` (first, last) only the changes
+    touching those lines of `src` are returned, so the rest of the document
+    is left as is.
+    """
+    src_lines = src.splitlines(keepends=True)
+    dst_lines = dst.splitlines(keepends=True)
+    if line_range is None:
+        return [
+            {
+                'range': {
+                    'start': {'line': 0, 'character': 0},
+                    'end': end_position(src_lines),
+                },
+                'newText': dst,
+            }
+        ]
+
+    first, last = line_range
+    edits = []
+    matcher = difflib.SequenceMatcher(None, src_lines, dst_lines, False)
+    for i1, i2, j1, j2 in _changed_hunks(matcher.get_opcodes()):
+        # Insertions (i1 == i2) belong to the line they are inserted before.
+        if i1 > last or max(i2 - 1, i1) < first:
+            continue
+
+        if i2 == len(src_lines) and i1 < i2:
+            end = end_position(src_lines)
+        else:
+            end = {'line': i2, 'character': 0}
+        edits.append(
+            {
+                'range': {'start': {'line': i1, 'character': 0}, 'end': end},
+                'newText': ''.join(dst_lines[j1:j2]),
+            }
+        )
+    return edits
+
+
+def _changed_hunks(opcodes):
+    """Yield the non-equal `opcodes` ranges, splitting replacements of the
+    same number of lines into one hunk per line."""
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            continue
+
+        if tag == 'replace' and i2 - i1 == j2 - j1:
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                yield i, i + 1, j, j + 1
+        else:
+            yield i1, i2, j1, j2
+
+
+class Workspace:
+    """Formatting settings of a single project root."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        config = root / 'setup.cfg'
+        if config.is_file():
+            args = ['--config', str(config)]
+        else:
+            args = [str(root)]
+        try:
+            ctx = main.make_context('brunette', args)
+            params = ctx.params
+        except (click.ClickException, KeyError, OSError) as e:
+            err(f'Cannot read configuration for {root}: {e}')
+            ctx = main.make_context('brunette', ['--config', os.devnull])
+            params = ctx.params
+
+        if params['target_version']:
+            versions = set(params['target_version'])
+        elif params['py36']:
+            versions = PY36_VERSIONS
+        else:
+            versions = set()
+        self.mode = FileMode(
+            target_versions=versions,
+            line_length=params['line_length'],
+            is_pyi=params['pyi'],
+            string_normalization=not params['skip_string_normalization'],
+        )
+        self.single_quotes = params['single_quotes']
+        self.fast = params['fast']
+        self.formatter = IncrementalFormatter()
+
+    def format(self, path: Path, src: str) -> str:
+        mode = self.mode
+        if path.suffix == '.pyi' and not mode.is_pyi:
+            mode = FileMode(
+                target_versions=mode.target_versions,
+                line_length=mode.line_length,
+                is_pyi=True,
+                string_normalization=mode.string_normalization,
+            )
+        patch_string_quotes(self.single_quotes)
+        try:
+            return self.formatter.format_file_contents(
+                src, fast=self.fast, mode=mode
+            )
+        except black.NothingChanged:
+            return src
+
+
+class LanguageServer:
+    """Dispatches JSON-RPC messages to the methods in `handlers`."""
+
+    def __init__(self) -> None:
+        self.documents: Dict[str, str] = {}
+        self.folders: List[Path] = []
+        self.workspaces: Dict[Path, Workspace] = {}
+        self.initialized = False
+        self.shutdown = False
+        self.handlers = {
+            'initialize': self.initialize,
+            'shutdown': self.request_shutdown,
+            'workspace/didChangeWorkspaceFolders': (
+                self.change_workspace_folders
+            ),
+            'textDocument/didOpen': self.open_document,
+            'textDocument/didChange': self.change_document,
+            'textDocument/didClose': self.close_document,
+            'textDocument/formatting': self.format_document,
+            'textDocument/rangeFormatting': self.format_range,
+        }
+
+    def workspace(self, path: Path) -> Workspace:
+        """Find the workspace `path` belongs to, reading its configuration
+        the first time it is used."""
+        for folder in sorted(self.folders, key=lambda p: -len(p.parts)):
+            if folder == path or folder in path.parents:
+                root = folder
+                break
+        else:
+            root = black.find_project_root((str(path.parent),))
+            if isinstance(root, tuple):
+                root = root[0]
+
+        if root not in self.workspaces:
+            self.workspaces[root] = Workspace(root)
+        return self.workspaces[root]
+
+    def initialize(self, params):
+        folders = params.get('workspaceFolders') or []
+        if folders:
+            self.folders = [uri_to_path(f['uri']) for f in folders]
+        elif params.get('rootUri'):
+            self.folders = [uri_to_path(params['rootUri'])]
+        elif params.get('rootPath'):
+            self.folders = [Path(params['rootPath'])]
+        self.initialized = True
+        return {
+            'capabilities': {
+                'textDocumentSync': {
+                    'openClose': True,
+                    'change': TEXT_DOCUMENT_SYNC_INCREMENTAL,
+                },
+                'documentFormattingProvider': True,
+                'documentRangeFormattingProvider': True,
+                'workspace': {
+                    'workspaceFolders': {
+                        'supported': True,
+                        'changeNotifications': True,
+                    }
+                },
+            },
+            'serverInfo': {'name': 'brunette', 'version': black.__version__},
+        }
+
+    def request_shutdown(self, params):
+        self.shutdown = True
+
+    def change_workspace_folders(self, params):
+        event = params['event']
+        for folder in event.get('removed', []):
+            path = uri_to_path(folder['uri'])
+            if path in self.folders:
+                self.folders.remove(path)
+            self.workspaces.pop(path, None)
+        for folder in event.get('added', []):
+            self.folders.append(uri_to_path(folder['uri']))
+
+    def open_document(self, params):
+        document = params['textDocument']
+        self.documents[document['uri']] = document['text']
+
+    def change_document(self, params):
+        uri = params['textDocument']['uri']
+        text = self.documents.get(uri, '')
+        for change in params['contentChanges']:
+            if 'range' not in change:
+                text = change['text']
+                continue
+
+            start = position_to_offset(text, change['range']['start'])
+            end = position_to_offset(text, change['range']['end'])
+            text = text[:start] + change['text'] + text[end:]
+        self.documents[uri] = text
+
+    def close_document(self, params):
+        self.documents.pop(params['textDocument']['uri'], None)
+
+    def format_document(self, params):
+        return self.format(params['textDocument']['uri'])
+
+    def format_range(self, params):
+        document_range = params['range']
+        end = document_range['end']
+        last = end['line']
+        if end['character'] == 0 and last > document_range['start']['line']:
+            last -= 1
+        return self.format(
+            params['textDocument']['uri'],
+            (document_range['start']['line'], last),
+        )
+
+    def format(self, uri, line_range=None):
+        src = self.documents[uri]
+        path = uri_to_path(uri)
+        dst = self.workspace(path).format(path, src)
+        if dst == src:
+            return []
+
+        return text_edits(src, dst, line_range)
+
+    def dispatch(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Handle a single message, returning the response for requests."""
+        method = message.get('method')
+        if method is None:
+            # A response to a request we never send.
+            return None
+
+        is_request = 'id' in message
+        handler = self.handlers.get(method)
+        response: Dict[str, Any] = {'jsonrpc': '2.0', 'id': message.get('id')}
+        if handler is None:
+            if not is_request:
+                return None
+
+            response['error'] = {
+                'code': METHOD_NOT_FOUND,
+                'message': f'Method not found: {method}',
+            }
+            return response
+
+        if not self.initialized and method != 'initialize':
+            if not is_request:
+                return None
+
+            response['error'] = {
+                'code': SERVER_NOT_INITIALIZED,
+                'message': 'Server not initialized',
+            }
+            return response
+
+        try:
+            result = handler(message.get('params') or {})
+        except Exception as e:
+            traceback.print_exc()
+            if not is_request:
+                return None
+
+            response['error'] = {'code': INTERNAL_ERROR, 'message': str(e)}
+            return response
+
+        if not is_request:
+            return None
+
+        response['result'] = result
+        return response
+
+
+def read_message(stream: IO[bytes]) -> Optional[Dict[str, Any]]:
+    """Read one JSON-RPC message, or None at the end of the stream."""
+    length = None
+    while True:
+        line = stream.readline()
+        if not line:
+            return None
+
+        line = line.strip()
+        if not line:
+            break
+
+        name, _, value = line.decode('ascii').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+
+    if length is None:
+        raise ValueError('Missing Content-Length header')
+
+    return json.loads(stream.read(length).decode('utf-8'))
+
+
+def write_message(stream: IO[bytes], message: Dict[str, Any]) -> None:
+    body = json.dumps(message).encode('utf-8')
+    stream.write(b'Content-Length: %d\r\n\r\n' % len(body))
+    stream.write(body)
+    stream.flush()
+
+
+def serve(stdin: IO[bytes], stdout: IO[bytes]) -> int:
+    """Serve requests until ``exit``, returning the process exit code."""
+    server = LanguageServer()
+    while True:
+        message = read_message(stdin)
+        if message is None or message.get('method') == 'exit':
+            return 0 if server.shutdown else 1
+
+        response = server.dispatch(message)
+        if response is not None:
+            write_message(stdout, response)
@@ -0,0 +1,28 @@
+"""Module docstring."""
+import os
+from typing import List
+x = 1; y = {  "a":1 }
+# A comment about first.
+def first(a,b):
+    return a+b
+    # Trailing comment of first.
+
+
+
+class Second( object ):
+    '''Docstring.'''
+    def method(self): return "value"
+if os.name == 'nt':
+    def third(): pass
+else:
+    x = 'value'
+@property
+def fourth(): return [ 1,2,
+  3 ]
+try:
+    import foo
+except ImportError:
+    foo = None
+raise SystemExit
+print("unreachable")
+# Comment at the end.
@@ -1,9 +1,20 @@
 import os
+import io
+import gzip
+import json
+import tarfile
 import tempfile
 import subprocess
 import importlib.util
+from pathlib import Path
 
+import black
 import pytest
+from click.testing import CliRunner
+
+from brunette.brunette import main, patch_string_quotes, should_verify
+import brunette.incremental
+from brunette.incremental import IncrementalFormatter, split_blocks
 
 NAME = 'brunette'
 SINGLE_QUOTES = 'single-quotes'
@@ -88,6 +99,372 @@ class Test:
 
         os.unlink(config_path)
 
+    def test_verify_fraction(self):
+        paths = [Path(f'pkg/module_{i}.py') for i in range(1000)]
+        sampled = [p for p in paths if should_verify(p, 0.25)]
+
+        assert sampled == [p for p in paths if should_verify(p, 0.25)]
+        assert 150 < len(sampled) < 350
+        assert all(should_verify(p, 1) for p in paths)
+        assert not any(should_verify(p, 0) for p in paths)
+
+    @pytest.mark.parametrize('fraction, return_code', [('1', 123), ('0', 1)])
+    def test_verify_fraction_check(self, monkeypatch, fraction, return_code):
+        def assert_equivalent(src, dst, **kwargs):
+            raise AssertionError('INTERNAL ERROR: not equivalent')
+
+        monkeypatch.setattr(black, 'assert_equivalent', assert_equivalent)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'example.py')
+            with open(path, 'w') as file_obj:
+                file_obj.write('x = {  "a":1 }\n')
+
+            result = CliRunner().invoke(
+                main, ['--check', '--verify-fraction', fraction, path]
+            )
+        assert result.exit_code == return_code
+
+    def test_verify_fraction_root(self):
+        root = Path(THIS_DIR).parent
+        relative = Path(os.path.relpath(__file__))
+        absolute = Path(__file__)
+        fractions = [i / 100 for i in range(1, 100)]
+
+        assert [should_verify(relative, f, root) for f in fractions] == [
+            should_verify(absolute, f, root) for f in fractions
+        ]
+        assert [should_verify(absolute, f, root) for f in fractions] == [
+            should_verify(Path('tests/test_brunette.py'), f) for f in fractions
+        ]
+
+    def test_files_from(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for name in ('good.py', 'bad.py', 'excluded.py'):
+                path = os.path.join(tmp_dir, name)
+                with open(path, 'w') as file_obj:
+                    file_obj.write(
+                        'x = {  "a":1 }\n' if name != 'good.py' else 'x = 1\n'
+                    )
+                paths.append(path)
+
+            args = [NAME, '--check', '--exclude', 'excluded', '--files-from']
+            good = subprocess.run(
+                args + ['-', '-z'],
+                input='\0'.join([paths[0], paths[2]]),
+                capture_output=True,
+                encoding='utf8',
+            )
+            manifest = os.path.join(tmp_dir, 'manifest.txt')
+            with open(manifest, 'w') as file_obj:
+                file_obj.write('\n'.join(paths) + '\n')
+
+            bad = subprocess.run(
+                args + [manifest], capture_output=True, encoding='utf8'
+            )
+            duplicates = subprocess.run(
+                args + ['-', paths[1]],
+                input='\n'.join([paths[1], paths[1], paths[0]]),
+                capture_output=True,
+                encoding='utf8',
+            )
+            missing = subprocess.run(
+                args + ['-'],
+                input=os.path.join(tmp_dir, 'missing.py'),
+                capture_output=True,
+                encoding='utf8',
+            )
+            empty = subprocess.run(
+                args + ['-'],
+                input=paths[2],
+                capture_output=True,
+                encoding='utf8',
+            )
+
+        assert good.returncode == 0
+        assert '1 file would be left unchanged' in good.stderr
+        assert bad.returncode == 1
+        assert '1 file would be reformatted' in bad.stderr
+        assert duplicates.returncode == 1
+        assert (
+            '1 file would be reformatted, 1 file would be left unchanged.'
+            in duplicates.stderr
+        )
+        assert missing.returncode == 123
+        assert 'missing.py: no such file' in missing.stderr
+        assert empty.returncode == 0
+        assert 'No Python files are present' in empty.stderr
+
+    def test_lsp(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'setup.cfg'), 'w') as file_obj:
+                file_obj.write(f'[tool:{NAME}]\n{SINGLE_QUOTES} = true')
+
+            uri = Path(tmp_dir, 'example.py').as_uri()
+            position = {'line': 1, 'character': 4}
+            messages = [
+                ('initialize', {'rootUri': Path(tmp_dir).as_uri()}),
+                ('initialized', {}),
+                (
+                    'textDocument/didOpen',
+                    {
+                        'textDocument': {
+                            'uri': uri,
+                            'languageId': 'python',
+                            'version': 1,
+                            'text': 'a = "x"\nb = 1\n',
+                        }
+                    },
+                ),
+                (
+                    'textDocument/didChange',
+                    {
+                        'textDocument': {'uri': uri, 'version': 2},
+                        'contentChanges': [
+                            {
+                                'range': {'start': position, 'end': position},
+                                'text': '{  "y":2 }  # ',
+                            }
+                        ],
+                    },
+                ),
+                ('textDocument/formatting', {'textDocument': {'uri': uri}}),
+                (
+                    'textDocument/rangeFormatting',
+                    {
+                        'textDocument': {'uri': uri},
+                        'range': {
+                            'start': {'line': 1, 'character': 0},
+                            'end': {'line': 2, 'character': 0},
+                        },
+                    },
+                ),
+                ('shutdown', None),
+                ('exit', None),
+            ]
+            stdin = b''
+            for i, (method, params) in enumerate(messages):
+                message = {
+                    'jsonrpc': '2.0',
+                    'method': method,
+                    'params': params,
+                }
+                if not method.startswith(
+                    'textDocument/did'
+                ) and method not in (
+                    'initialized',
+                    'exit',
+                ):
+                    message['id'] = i
+                body = json.dumps(message).encode('utf8')
+                stdin += b'Content-Length: %d\r\n\r\n%s' % (len(body), body)
+
+            result = subprocess.run(
+                [NAME, '--lsp'], input=stdin, capture_output=True, cwd=tmp_dir
+            )
+
+        assert result.returncode == 0
+        responses = {r['id']: r for r in _read_lsp_messages(result.stdout)}
+        assert responses[0]['result']['capabilities'][
+            'documentRangeFormattingProvider'
+        ]
+        assert responses[4]['result'][0]['newText'] == (
+            "a = 'x'\nb = {'y': 2}  # 1\n"
+        )
+        assert responses[5]['result'] == [
+            {
+                'range': {
+                    'start': {'line': 1, 'character': 0},
+                    'end': {'line': 2, 'character': 0},
+                },
+                'newText': "b = {'y': 2}  # 1\n",
+            }
+        ]
+
+    def test_tar(self):
+        sources = {
+            'pkg/bad.py': b'x = {  "a":1 }\n',
+            'pkg/good.py': b"x = {'a': 1}\n",
+            'pkg/README': b'x = {  "a":1 }\n',
+        }
+        stdin = io.BytesIO()
+        with tarfile.open(fileobj=stdin, mode='w') as archive:
+            for name, data in sources.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+        result = subprocess.run(
+            [NAME, '--tar', SINGLE_QUOTES_OP],
+            input=stdin.getvalue(),
+            capture_output=True,
+        )
+        check = subprocess.run(
+            [NAME, '--tar', '--check', SINGLE_QUOTES_OP],
+            input=stdin.getvalue(),
+            capture_output=True,
+        )
+
+        assert result.returncode == 0
+        with tarfile.open(fileobj=io.BytesIO(result.stdout)) as archive:
+            results = {
+                member.name: archive.extractfile(member).read()
+                for member in archive
+            }
+        assert results == dict(sources, **{'pkg/bad.py': b"x = {'a': 1}\n"})
+        conflict = subprocess.run(
+            [NAME, '--tar', THIS_DIR], input=b'', capture_output=True
+        )
+        diffs = subprocess.run(
+            [NAME, '--tar', '--diff', '--diff-format', 'jsonl', '--diff-gzip'],
+            input=stdin.getvalue(),
+            capture_output=True,
+        )
+        invalid = [
+            subprocess.run(
+                [NAME, '--tar', '--check'], input=data, capture_output=True
+            )
+            for data in (b'', b'x\n', stdin.getvalue()[:1000])
+        ]
+
+        assert check.returncode == 1
+        assert check.stdout == b''
+        assert conflict.returncode == 2
+        records = [
+            json.loads(line)
+            for line in gzip.decompress(diffs.stdout).splitlines()
+        ]
+        assert [record['path'] for record in records] == ['pkg/bad.py']
+        assert b'1 file would be reformatted' in check.stderr
+        for broken in invalid:
+            assert broken.returncode == 123
+            assert b'cannot read tar archive' in broken.stderr
+
+    @pytest.mark.parametrize('single_quotes', [False, True])
+    def test_incremental(self, single_quotes):
+        src = _get_demo_content('incremental_in')
+        mode = black.FileMode(line_length=79)
+        formatter = IncrementalFormatter()
+        # (old, new, number of blocks to format again)
+        edits = [
+            ('import os', 'import os, sys', 1),
+            ('def first(a,b):', '@decorator\ndef first(a,b) :', 1),
+            (
+                "    x = 'value'",
+                "    x = 'changed'\n\n\nclass Inserted: pass",
+                2,
+            ),
+        ]
+        patch_string_quotes(single_quotes)
+        try:
+            assert formatter.format_str(src, mode=mode) == black.format_str(
+                src, mode=mode
+            )
+            for old, new, changed in edits:
+                src = src.replace(old, new, 1)
+                blocks = len(formatter.blocks)
+                result = formatter.format_str(src, mode=mode, fast=False)
+                assert result == black.format_str(src, mode=mode)
+                assert len(formatter.blocks) - blocks == changed
+            # The `u` prefix is only removed because of the first block.
+            src = (
+                'from __future__ import unicode_literals\n'
+                'print("a" % 1)\n'
+                'x = u"a"\n'
+            )
+            assert formatter.format_str(src, mode=mode) == black.format_str(
+                src, mode=mode
+            )
+        finally:
+            patch_string_quotes(False)
+
+    def test_incremental_checks_fast_blocks(self, monkeypatch):
+        checked = []
+        monkeypatch.setattr(
+            brunette.incremental,
+            'check_stability_and_equivalence',
+            lambda src, dst, mode: checked.append(src),
+        )
+        src = _get_demo_content('incremental_in')
+        mode = black.FileMode(line_length=79)
+        formatter = IncrementalFormatter()
+
+        formatter.format_str(src, mode=mode, fast=True)
+        assert not checked
+        formatter.format_str(src, mode=mode, fast=False)
+        assert checked
+        checked.clear()
+        formatter.format_str(src, mode=mode, fast=False)
+        assert not checked
+
+    def test_split_blocks(self):
+        src = _get_demo_content('incremental_in')
+        blocks = split_blocks(src)
+        joined = ''.join('\n' * blank + block for block, blank in blocks)
+
+        assert joined == src.rstrip('\n') + '\n'
+        assert [block.split('\n')[0] for block, _ in blocks][:4] == [
+            '"""Module docstring."""',
+            'import os',
+            'from typing import List',
+            'x = 1; y = {  "a":1 }',
+        ]
+
+    def test_diff_ordered(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            names = ['d.py', 'b.py', 'ok.py', 'a.py', 'c.py']
+            for name in names:
+                with open(os.path.join(tmp_dir, name), 'w') as file_obj:
+                    file_obj.write(
+                        'x = 1\n' if name == 'ok.py' else 'x = {  "a":1 }\n'
+                    )
+
+            args = [NAME, '--diff', '--workers', '2', tmp_dir]
+            unified = subprocess.run(
+                args, capture_output=True, encoding='utf8'
+            )
+            archived = subprocess.run(
+                args + ['--diff-format', 'jsonl', '--diff-gzip'],
+                capture_output=True,
+            )
+
+        expected = [
+            os.path.join(tmp_dir, name)
+            for name in sorted(names)
+            if name != 'ok.py'
+        ]
+        assert unified.returncode == 0
+        assert [
+            line.split('\t')[0][4:]
+            for line in unified.stdout.splitlines()
+            if line.startswith('--- ')
+        ] == expected
+        records = [
+            json.loads(line)
+            for line in gzip.decompress(archived.stdout).splitlines()
+        ]
+        assert [record['path'] for record in records] == expected
+        assert records[0]['diff'].endswith('+x = {"a": 1}\n')
+
+    def test_diff_stdin(self):
+        result = subprocess.run(
+            [NAME, '--diff', '-'],
+            input='a=1\n',
+            capture_output=True,
+            encoding='utf8',
+        )
+
+        assert result.stdout.startswith('--- STDIN\t')
+        assert '\n+++ STDOUT\t' in result.stdout
+
+
+def _read_lsp_messages(output: bytes):
+    while output:
+        header, _, output = output.partition(b'\r\n\r\n')
+        length = int(header.split(b':')[1])
+        yield json.loads(output[:length])
+        output = output[length:]
+
 
 def _get_result_lines(args):
     return _lines(subprocess.check_output(args, encoding='utf8'))